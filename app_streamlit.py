@@ -7,9 +7,23 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
+import openpyxl
+import xlsxwriter
+import re
 from io import BytesIO
 from datetime import datetime
 
+# Rust-backed reader, used when installed and pandas (>= 2.2) knows the engine
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine' if tuple(map(int, pd.__version__.split('.')[:2])) >= (2, 2) else None
+except ImportError:
+    EXCEL_ENGINE = None
+
+# Entries kept per cached function; each holds a copy of one upload's frames,
+# and the caches are shared by every session of the process
+CACHE_MAX_ENTRIES = 16
+
 st.set_page_config(page_title="CarbonOracle", page_icon="🦥", layout="wide")
 
 # ============ Molecular Database ============
@@ -32,116 +46,397 @@ MOLECULAR_DB = {
     'Talose': {'mw': 180.16, 'carbon': 6},
 }
 
-def get_carbon_fraction(name):
-    db = MOLECULAR_DB.get(name, {'mw': 120.10, 'carbon': 4})
-    return db['carbon'] * 12 / db['mw']
+C4_CARBON_FRACTION = 4 * 12 / 120.10
+GALD_CARBON_FRACTION = 2 * 12 / 60.05
+DEFAULT_CARBON_FRACTION = C4_CARBON_FRACTION
+
+# Struct-of-arrays view of MOLECULAR_DB: name -> row index into a carbon-fraction
+# column, whose extra last row holds the default for unknown compounds (C4)
+MOLECULE_INDEX = {name: i for i, name in enumerate(MOLECULAR_DB)}
+UNKNOWN_MOLECULE_INDEX = len(MOLECULAR_DB)
+CARBON_FRACTIONS = np.array([db['carbon'] * 12 / db['mw'] for db in MOLECULAR_DB.values()]
+                            + [DEFAULT_CARBON_FRACTION], dtype=np.float64)
+
+def get_carbon_fractions(names):
+    """Carbon mass fraction per compound name: one hash probe per name, then a single gather"""
+    codes = names.map(MOLECULE_INDEX).fillna(UNKNOWN_MOLECULE_INDEX).to_numpy(dtype=np.intp)
+    return CARBON_FRACTIONS[codes]
+
+# Lower-cased, so names match regardless of how the sheet capitalises them
+C4_SUGARS = frozenset(['erythrose', 'threose', 'erythrulose', '赤藓糖', '苏阿糖', '赤藓酮糖'])
 
 def get_sugar_type(name):
-    c4_sugars = ['Erythrose', 'Threose', 'Erythrulose', '赤藓糖', '苏阿糖', '赤藓酮糖']
-    if name in c4_sugars:
+    if name.lower() in C4_SUGARS:
         return 'C4'
     return 'C6'
 
-def build_rt_reference(standard_df, compound_col='Compound', rt_col='Retention_Time'):
-    rt_ref = {}
-    for _, row in standard_df.iterrows():
-        compound = row.get(compound_col)
-        rt = row.get(rt_col)
-        if pd.notna(rt) and pd.notna(compound):
-            rt_ref[round(float(rt), 6)] = str(compound).strip()
-    return rt_ref
+def get_sugar_types(names):
+    """Vectorized get_sugar_type: each distinct name is classified once"""
+    codes, uniques = pd.factorize(names)
+    types = np.array([get_sugar_type(name) for name in uniques] + [None], dtype=object)
+    return types[codes]
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
 def scan_rt_matches(standard_df, reaction_df, std_compound_col='Compound', std_rt_col='Retention_Time', 
                     rxn_rt_col='Retention_Time', tolerance=0.15):
-    import numpy as np
-    
-    std_rts = []
-    for _, row in standard_df.iterrows():
-        compound = row.get(std_compound_col)
-        rt = row.get(std_rt_col)
-        if pd.notna(compound) and pd.notna(rt):
-            std_rts.append({'compound': str(compound).strip(), 'std_rt': round(float(rt), 6)})
+    if std_compound_col not in standard_df.columns or std_rt_col not in standard_df.columns:
+        return {}
+
+    std = standard_df[[std_compound_col, std_rt_col]].dropna()
+    compounds = std[std_compound_col].astype(str).str.strip()
+    std_rts = np.round(std[std_rt_col].to_numpy(dtype=np.float64), 6)
+    rxn_rts = reaction_df[rxn_rt_col].dropna().to_numpy(dtype=np.float64)
     
-    rxn_rts = reaction_df[rxn_rt_col].dropna().tolist()
-    rxn_rts_array = np.array(rxn_rts)
+    if len(rxn_rts):
+        # Closest reaction RT for every standard at once (first listed on ties)
+        closest_idx, _ = nearest_rt(std_rts, rxn_rts)
+        closest_rt = rxn_rts[closest_idx]
+        matched_rt = np.round(closest_rt, 6)
+        deviation = np.round(closest_rt - std_rts, 6)
+        min_dev = np.abs(closest_rt - std_rts)
+        abs_deviation = np.round(min_dev, 6)
+        is_match = min_dev <= tolerance
+    else:
+        matched_rt = deviation = abs_deviation = [None] * len(std_rts)
+        is_match = [False] * len(std_rts)
     
     matches = {}
-    for std in std_rts:
-        compound = std['compound']
-        std_rt = std['std_rt']
-        
-        deviations = np.abs(rxn_rts_array - std_rt)
-        min_dev = np.min(deviations) if len(deviations) > 0 else None
-        closest_idx = np.argmin(deviations) if len(deviations) > 0 else None
-        closest_rt = rxn_rts[closest_idx] if closest_idx is not None else None
-        
-        matches[compound] = {
-            'std_rt': std_rt,
-            'matched_rt': round(closest_rt, 6) if closest_rt is not None else None,
-            'deviation': round(closest_rt - std_rt, 6) if closest_rt is not None else None,
-            'abs_deviation': round(min_dev, 6) if min_dev is not None else None,
-            'is_match': min_dev <= tolerance if min_dev is not None else False
-        }
+    for row in zip(compounds, std_rts, matched_rt, deviation, abs_deviation, is_match):
+        compound, *values = row
+        matches[compound] = dict(zip(
+            ('std_rt', 'matched_rt', 'deviation', 'abs_deviation', 'is_match'), values))
     
     return matches
 
-def get_peak_by_rt(reaction_df, target_rt, tolerance=0.15, rxn_rt_col='Retention_Time', area_col='Peak_Area'):
-    for _, row in reaction_df.iterrows():
-        rt = row.get(rxn_rt_col)
-        if pd.notna(rt) and abs(float(rt) - target_rt) <= tolerance:
-            return row.get(area_col)
-    return None
+# Column roles by header keyword, compiled once (case-insensitive). Order
+# matters: a header takes the first role it matches, and the last header
+# matching a role wins. 'rt' must stand apart from other letters, so headers
+# like 'RT (min)' or 'RT_min' match but 'Start' does not.
+RT_PATTERN = re.compile(r'(?<![a-z])rt(?![a-z])|retention|保留时间', re.I)
+SUMMARY_COLUMN_PATTERNS = {
+    'compound': re.compile(r'^compound$|4c|standard', re.I),
+    'area': re.compile(r'area|峰面积', re.I),
+    'conc': re.compile(r'concentration|浓度', re.I),
+}
+REACTION_COLUMN_PATTERNS = {
+    'enzyme': re.compile(r'enzyme|酶名称', re.I),
+    'area': re.compile(r'area|峰面积', re.I),
+    'rt': RT_PATTERN,
+    'compound': re.compile(r'compound|物质', re.I),
+}
 
-def export_to_excel(results, c4_response, gald_response):
+def infer_columns(columns, patterns):
+    """Map each role in patterns to a column, one regex search per header and role"""
+    names = [str(col).strip() for col in columns]
+    unassigned = [True] * len(names)
+    col_map = {}
+    for role, pattern in patterns.items():
+        hits = [i for i, name in enumerate(names) if unassigned[i] and pattern.search(name)]
+        if hits:
+            col_map[role] = columns[hits[-1]]
+            for i in hits:
+                unassigned[i] = False
+    return col_map
+
+def find_rt_column(columns, default='Retention_Time'):
+    """Pick the retention-time column, preferring an exact 'Retention_Time' header"""
+    if default in columns:
+        return default
+    for col in columns:
+        if RT_PATTERN.search(str(col)):
+            return col
+    return default
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def select_columns(df, dtypes):
+    """Project df onto the mapped columns that exist, cast to their declared dtypes
+
+    String columns are stripped here, once, so later steps compare plain values.
+    Numeric columns are coerced, so stray text in a cell becomes NaN instead of
+    failing the cast or leaving an object column behind.
+    """
+    dtypes = {col: dtype for col, dtype in dtypes.items() if col in df.columns}
+    df = df[list(dtypes)].copy()
+    for col, dtype in dtypes.items():
+        if dtype == 'string':
+            df[col] = df[col].astype('string').str.strip()
+        else:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+    return df
+
+def nearest_rt(values, ref_rts):
+    """Index of the nearest reference RT for each value, and the signed deviation
+
+    Binary search over the sorted references, then compare the two neighbours,
+    so each lookup is O(log S) instead of a scan over every standard. Ties go to
+    the reference listed first.
+    """
+    order = np.argsort(ref_rts, kind='stable')
+    sorted_rts = ref_rts[order]
+    pos = np.searchsorted(sorted_rts, values)
+    right = np.clip(pos, 0, len(sorted_rts) - 1)
+    # First of any run of equal RTs, which the stable sort keeps in listing order
+    left = np.searchsorted(sorted_rts, sorted_rts[np.clip(pos - 1, 0, len(sorted_rts) - 1)])
+    left_dev = np.abs(values - sorted_rts[left])
+    right_dev = np.abs(values - sorted_rts[right])
+    nearest = np.where((right_dev < left_dev)
+                       | ((right_dev == left_dev) & (order[right] < order[left])), right, left)
+    return order[nearest], values - sorted_rts[nearest]
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def parse_reactions(reaction_df, reaction_col_map, rxn_rt_col, rt_matches, tolerance=0.15):
+    """Parse reaction rows into a long-form frame with one row per peak
+
+    Enzyme names only appear on the first row of each block, so they are
+    forward-filled; blank compounds are predicted from the nearest standard RT.
+    A name that starts a second block replaces its earlier block, whose rows are
+    kept for display but flagged 'superseded'.
+    Name columns are expected stripped and RT/area columns float64 (see select_columns).
+    Returns the parsed frame and the enzyme names in sheet order.
+    """
+    index = reaction_df.index
+    name_cell = reaction_df[reaction_col_map['enzyme']].astype('string')
+    name_cell = name_cell.mask(name_cell == '')
+    enzyme = name_cell.ffill()
+
+    # Every filled name cell starts a block; only the last block under each
+    # name counts towards its yield
+    block = pd.Series(np.cumsum(name_cell.notna().to_numpy(dtype=bool)), index=index)
+    superseded = block != block.groupby(enzyme).transform('max')
+
+    if 'compound' in reaction_col_map:
+        substance = reaction_df[reaction_col_map['compound']].astype('string')
+        needs_rt = (substance == '').fillna(False).astype(bool)
+    else:
+        substance = pd.Series(pd.NA, index=index, dtype='string')
+        needs_rt = pd.Series(True, index=index)
+
+    if rxn_rt_col in reaction_df.columns:
+        rt = reaction_df[rxn_rt_col]
+    else:
+        rt = pd.Series(np.nan, index=index)
+
+    # Nearest standard within tolerance for every row that needs a prediction
+    rt_deviation = pd.Series(np.nan, index=index)
+    is_predicted = pd.Series(False, index=index)
+    predict = needs_rt & rt.notna()
+    if predict.any():
+        std_names = np.array(list(rt_matches), dtype=object)
+        std_rts = np.array([m['std_rt'] for m in rt_matches.values()], dtype=np.float64)
+        if std_rts.size:
+            nearest, dev = nearest_rt(rt[predict].to_numpy(dtype=np.float64), std_rts)
+            matched = np.abs(dev) <= tolerance
+            substance[predict] = np.where(matched, std_names[nearest], 'Unknown')
+            rt_deviation[predict] = np.where(matched, np.round(dev, 6), np.nan)
+            is_predicted[predict] = matched
+        else:
+            substance[predict] = 'Unknown'
+
+    # Integer code per row (in sheet order of first appearance) for array aggregation
+    enzyme_codes, enzymes = pd.factorize(enzyme)
+
+    keep = substance.notna() & enzyme.notna()
+    parsed = pd.DataFrame({
+        'enzyme': enzyme[keep],
+        'enzyme_code': enzyme_codes[keep.to_numpy()],
+        'compound': substance[keep],
+        'peak': reaction_df.loc[keep, reaction_col_map['area']],
+        'rt': rt[keep],
+        'rt_deviation': rt_deviation[keep],
+        'is_predicted': is_predicted[keep],
+        'superseded': superseded[keep].astype(bool),
+    })
+    return parsed, list(enzymes)
+
+def excel_value(value):
+    """Cell value as DataFrame.to_excel writes it: NaN blank, infinities as 'inf' text"""
+    if pd.isna(value):
+        return None
+    if isinstance(value, float) and np.isinf(value):
+        return 'inf' if value > 0 else '-inf'
+    return value
+
+def write_frame(workbook, sheet_name, df):
+    """Write a DataFrame to a new worksheet in row order: header, then values"""
+    ws = workbook.add_worksheet(sheet_name)
+    ws.write_row(0, 0, list(df.columns))
+    for i, row in enumerate(df.itertuples(index=False, name=None), 1):
+        ws.write_row(i, 0, [excel_value(v) for v in row])
+
+def compute_yields(product_codes, product_peaks, product_cfs, gald_peaks, c4_response, gald_response):
+    """Carbon balance per enzyme from flat arrays
+
+    product_codes/peaks/cfs hold one entry per product peak, gald_peaks one per
+    enzyme. Returns per-product carbon, then per-enzyme product carbon, GALD
+    carbon and carbon yield (%), all in one vectorized pass.
+    """
+    carbon = product_peaks * (1.0 / c4_response) * product_cfs
+    product_carbon = np.bincount(product_codes, weights=carbon, minlength=len(gald_peaks))
+    gald_carbon = gald_peaks / gald_response * GALD_CARBON_FRACTION
+    total = gald_carbon + product_carbon
+    # No carbon at all is a 0% yield; an undefined balance stays NaN
+    # Divide first, as the original formula did: p / p is exactly 1, so an enzyme
+    # with no GALD left gets exactly 100% (not 100.00000000000001)
+    yield_pct = np.divide(product_carbon, total, out=np.where(np.isnan(total), np.nan, 0.0),
+                          where=total > 0) * 100
+    return carbon, product_carbon, gald_carbon, yield_pct
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def export_to_excel(results_df, product_details, c4_response, gald_response):
     """Export results to Excel"""
     output = BytesIO()
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    # Rows go straight to xlsxwriter in order, so constant_memory can stream each
+    # one to disk instead of pandas formatting and buffering every cell
+    with xlsxwriter.Workbook(output, {'constant_memory': True, 'strings_to_formulas': False,
+                                      'strings_to_urls': False}) as workbook:
         # Summary sheet
-        summary_data = []
-        for i, r in enumerate(results, 1):
-            summary_data.append({
-                'Rank': i,
-                'Enzyme': r['enzyme'],
-                'Carbon_Yield_%': r['yield_pct'],
-                'Conversion_%': r['conversion_pct'],
-                'Product_Carbon_mgC_mL': r['product_carbon'],
-                'GALD_Carbon_mgC_mL': r['gald_carbon'],
-            })
-        pd.DataFrame(summary_data).to_excel(writer, sheet_name='Carbon_Yield_Summary', index=False)
+        summary_df = pd.DataFrame({
+            'Rank': np.arange(1, len(results_df) + 1),
+            'Enzyme': results_df['enzyme'],
+            'Carbon_Yield_%': results_df['yield_pct'],
+            'Conversion_%': results_df['conversion_pct'],
+            'Product_Carbon_mgC_mL': results_df['product_carbon'],
+            'GALD_Carbon_mgC_mL': results_df['gald_carbon'],
+        })
+        write_frame(workbook, 'Carbon_Yield_Summary', summary_df)
         
-        # Individual enzyme sheets
-        for r in results:
-            sheet_name = r['enzyme'].replace(' ', '_')[:31]
-            detail_data = []
-            # GALD
-            detail_data.append({
-                'Compound': 'GALD (Remaining)',
-                'Type': 'C2',
-                'Peak_Area': r.get('gald_peak', 0),
-                'Concentration_mg_mL': r['gald_carbon'] / (2*12/60.05),
-                'Carbon_Mass_mgC_mL': r['gald_carbon'],
-            })
-            # Products
-            for prod in r.get('products', []):
-                detail_data.append({
-                    'Compound': prod['name'],
-                    'Type': 'C4',
-                    'Peak_Area': prod['peak'],
-                    'Concentration_mg_mL': prod['peak'] / c4_response,
-                    'Carbon_Mass_mgC_mL': prod['carbon'],
-                })
-            pd.DataFrame(detail_data).to_excel(writer, sheet_name=sheet_name, index=False)
+        # Product details for all enzymes in one sheet: per enzyme in rank order,
+        # the remaining GALD first, then its products
+        gald_details = pd.DataFrame({
+            'Enzyme': results_df['enzyme'],
+            'Compound': 'GALD (Remaining)',
+            'Type': 'C2',
+            'Peak_Area': results_df['gald_peak'],
+            'Concentration_mg_mL': results_df['gald_carbon'] / GALD_CARBON_FRACTION,
+            'Carbon_Mass_mgC_mL': results_df['gald_carbon'],
+        })
+        details = pd.concat([gald_details, product_details], ignore_index=True)
+        rank = pd.Index(results_df['enzyme']).get_indexer(details['Enzyme'])
+        write_frame(workbook, 'Product_Details', details.iloc[np.argsort(rank, kind='stable')])
         
         # Standard curves
-        std_data = [
-            {'Sugar_Type': 'C4', 'Response_Factor': c4_response, 'Carbon_Fraction': 4*12/120.10},
-            {'Sugar_Type': 'C2(GALD)', 'Response_Factor': gald_response, 'Carbon_Fraction': 2*12/60.05},
-        ]
-        pd.DataFrame(std_data).to_excel(writer, sheet_name='Standard_Curves', index=False)
+        std_df = pd.DataFrame({
+            'Sugar_Type': ['C4', 'C2(GALD)'],
+            'Response_Factor': [c4_response, gald_response],
+            'Carbon_Fraction': [C4_CARBON_FRACTION, GALD_CARBON_FRACTION],
+        })
+        write_frame(workbook, 'Standard_Curves', std_df)
     
     return output.getvalue()
 
+def standard_curve(standard_df, compound_col, area_col, conc_col):
+    """C4 and GALD response factors (peak area per mg/mL), None if a standard is missing"""
+    compound = standard_df[compound_col]
+    response = (standard_df[area_col].to_numpy(dtype=np.float64)
+                / standard_df[conc_col].to_numpy(dtype=np.float64))
+
+    # Mean response over every C4 standard row (missing values skipped)
+    c4_mask = compound.str.lower().isin(C4_SUGARS).fillna(False).to_numpy(dtype=bool)
+    c4_response = np.nanmean(response[c4_mask]) if c4_mask.any() else None
+
+    # GALD uses its first standard row
+    gald_idx = np.flatnonzero((compound == 'GALD').fillna(False).to_numpy(dtype=bool))
+    gald_response = response[gald_idx[0]] if len(gald_idx) else None
+    return c4_response, gald_response
+
+def build_rt_match_table(parsed):
+    """Display table of the parsed peaks, one row per peak"""
+    return pd.DataFrame({
+        'Enzyme': parsed['enzyme'],
+        'RT': parsed['rt'].round(6),
+        'Compound': parsed['compound'].mask(parsed['compound'] == 'Unknown'),
+        'RT_Deviation': parsed['rt_deviation'].map(lambda d: '-' if pd.isna(d) else f"{d:+.6f}"),
+        'Peak_Area': parsed['peak'].round(6),
+    }).reset_index(drop=True)
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_yield_chart_spec(results_df):
+    """Vega-Lite spec of the yield bar chart, compiled by Altair once per result set
+
+    Only the plotted and tooltip columns should be passed in: Altair inlines
+    the whole frame into the spec sent to the browser.
+    """
+    chart = alt.Chart(results_df).mark_bar(cornerRadiusEnd=4).encode(
+        x=alt.X('enzyme', title='Enzyme', sort='-y'),
+        y=alt.Y('yield_pct', title='Carbon Yield (%)', scale=alt.Scale(domain=[0, 100])),
+        color=alt.Color('yield_pct', scale=alt.Scale(domain=[0, 100], range=['#90CAF9', '#1565C0']), legend=None),
+        tooltip=['enzyme', 'yield_pct', 'conversion_pct', 'product_carbon']
+    ).properties(
+        height=350,
+        width=600
+    ).configure_axis(
+        labelFontSize=12,
+        titleFontSize=14
+    )
+    return chart.to_dict()
+
+STANDARD_SHEET_NAMES = ['Standard Curve', '汇总', 'Summary']
+REACTION_SHEET_NAMES = ['Reaction Data', 'Reaction', '反应数据']
+
+def find_sheet(sheet_names, candidates):
+    return next((name for name in candidates if name in sheet_names), None)
+
+def worksheet_to_df(ws):
+    """Build a DataFrame from a read-only worksheet, first row as header"""
+    # Read-only mode trusts the stored sheet dimensions, which some instrument
+    # exporters write wrongly; drop them so every populated row is streamed
+    ws.reset_dimensions()
+    rows = list(ws.values)
+    while rows and all(v is None for v in rows[-1]):
+        rows.pop()
+    if not rows:
+        return pd.DataFrame()
+    # Without stored dimensions rows come back ragged; a data cell past the
+    # last header gets an 'Unnamed' column, as read_excel does
+    width = max(len(row) for row in rows)
+    header = list(rows[0]) + [None] * (width - len(rows[0]))
+    header = [f'Unnamed: {i}' if h is None else h for i, h in enumerate(header)]
+    return pd.DataFrame(rows[1:], columns=dedup_header(header))
+
+def dedup_header(header):
+    """Rename repeated headers the way read_excel does: 'Area', 'Area.1', ..."""
+    counts = {}
+    names = []
+    for name in header:
+        count = counts.get(name, 0)
+        while count:
+            counts[name] = count + 1
+            name = f'{name}.{count}'
+            count = counts.get(name, 0)
+        names.append(name)
+        counts[name] = count + 1
+    return names
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_sheets(file_bytes):
+    """Read the standard curve and reaction sheets, cached on the uploaded bytes"""
+    # calamine parses .xls and .xlsx alike; without it legacy .xls (not a zip
+    # archive) has to go through pandas/xlrd
+    if EXCEL_ENGINE or not file_bytes.startswith(b'PK'):
+        xl = pd.ExcelFile(BytesIO(file_bytes), engine=EXCEL_ENGINE)
+        standard_name = find_sheet(xl.sheet_names, STANDARD_SHEET_NAMES)
+        reaction_name = find_sheet(xl.sheet_names, REACTION_SHEET_NAMES)
+        sheets = pd.read_excel(xl, sheet_name=[n for n in (standard_name, reaction_name) if n])
+        standard_df, reaction_df = sheets.get(standard_name), sheets.get(reaction_name)
+    else:
+        # Values only: read-only mode streams cells and skips styles entirely
+        wb = openpyxl.load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+        try:
+            standard_name = find_sheet(wb.sheetnames, STANDARD_SHEET_NAMES)
+            reaction_name = find_sheet(wb.sheetnames, REACTION_SHEET_NAMES)
+            standard_df = worksheet_to_df(wb[standard_name]) if standard_name else None
+            reaction_df = worksheet_to_df(wb[reaction_name]) if reaction_name else None
+        finally:
+            wb.close()
+
+    # Clean column names here so reruns get them from the cache already stripped
+    # (as text: a numeric header would otherwise turn into NaN)
+    for df in (standard_df, reaction_df):
+        if df is not None:
+            df.columns = df.columns.astype(str).str.strip()
+    return standard_df, reaction_df
+
 # ============ Main Interface ============
 st.title("🔬 CarbonOracle")
 
@@ -166,74 +461,38 @@ uploaded_file = st.file_uploader("Choose Excel File", type=['xlsx', 'xls'])
 
 if uploaded_file:
     try:
-        xl = pd.ExcelFile(uploaded_file)
-        
-        # Read data
+        # Read data (cached, so reruns skip re-parsing the workbook)
         # Try both English and Chinese sheet names
-        standard_names = ['Standard Curve', '汇总', 'Summary']
-        reaction_names = ['Reaction Data', 'Reaction', '反应数据']
-        
-        standard_df = None
-        for name in standard_names:
-            if name in xl.sheet_names:
-                standard_df = pd.read_excel(xl, sheet_name=name)
-                break
+        standard_df, reaction_df = load_sheets(uploaded_file.getvalue())
         if standard_df is None:
             st.error("Standard Curve sheet not found")
             st.stop()
         
-        reaction_df = None
-        for name in reaction_names:
-            if name in xl.sheet_names:
-                reaction_df = pd.read_excel(xl, sheet_name=name)
-                break
         if reaction_df is None:
             st.error("Reaction Data sheet not found")
             st.stop()
         
-        # Clean column names
-        standard_df.columns = standard_df.columns.str.strip()
-        reaction_df.columns = reaction_df.columns.str.strip()
-        
         # Map column names (support both English and Chinese)
-        summary_col_map = {}
-        reaction_col_map = {}
-        
-        # Summary sheet column mapping
-        for col in standard_df.columns:
-            col_lower = str(col).lower().strip()
-            if col_lower == 'compound' or '4c' in col_lower or 'standard' in col_lower:
-                summary_col_map['compound'] = col
-            elif 'area' in col_lower or '峰面积' in col:
-                summary_col_map['area'] = col
-            elif 'concentration' in col_lower or '浓度' in col:
-                summary_col_map['conc'] = col
-        
-        # Reaction sheet column mapping
-        for col in reaction_df.columns:
-            col_lower = str(col).lower().strip()
-            if 'enzyme' in col_lower or '酶名称' in col:
-                reaction_col_map['enzyme'] = col
-            elif 'area' in col_lower or '峰面积' in col:
-                reaction_col_map['area'] = col
-            elif 'rt' in col_lower or 'retention' in col_lower or '保留时间' in col:
-                reaction_col_map['rt'] = col
-            elif 'compound' in col_lower or '物质' in col or '对应物质' in col:
-                reaction_col_map['compound'] = col
+        summary_col_map = infer_columns(standard_df.columns, SUMMARY_COLUMN_PATTERNS)
+        reaction_col_map = infer_columns(reaction_df.columns, REACTION_COLUMN_PATTERNS)
 
         # ============ Scan RT Matches from Reaction Data ============
-        rt_time_col = 'Retention_Time'
-        if rt_time_col not in standard_df.columns:
-            for col in standard_df.columns:
-                if 'rt' in str(col).lower() or 'retention' in str(col).lower():
-                    rt_time_col = col
-                    break
-
-        rxn_rt_col = 'Retention_Time'
-        for col in reaction_df.columns:
-            if 'rt' in str(col).lower() or 'retention' in str(col).lower():
-                rxn_rt_col = col
-                break
+        rt_time_col = find_rt_column(standard_df.columns)
+        rxn_rt_col = find_rt_column(reaction_df.columns)
+
+        # Keep only the columns used below, with explicit dtypes instead of inferred objects
+        standard_df = select_columns(standard_df, {
+            summary_col_map.get('compound'): 'string',
+            summary_col_map.get('area'): 'float64',
+            summary_col_map.get('conc'): 'float64',
+            rt_time_col: 'float64',
+        })
+        reaction_df = select_columns(reaction_df, {
+            reaction_col_map.get('enzyme'): 'string',
+            reaction_col_map.get('compound'): 'string',
+            reaction_col_map.get('area'): 'float64',
+            rxn_rt_col: 'float64',
+        })
 
         rt_matches = scan_rt_matches(standard_df, reaction_df,
                                      std_compound_col=summary_col_map.get('compound', 'Compound'),
@@ -246,97 +505,53 @@ if uploaded_file:
             st.error("Required columns not found: Enzyme Name, Peak Area")
             st.stop()
 
-        has_compound = 'compound' in reaction_col_map
-        tolerance = 0.15
-
-        reactions = {}
-        current_enzyme = None
-        rt_predictions = []
-
-        for idx, row in reaction_df.iterrows():
-            enzyme = row.get(reaction_col_map.get('enzyme'))
-            if pd.notna(enzyme) and str(enzyme).strip() != '':
-                current_enzyme = str(enzyme).strip()
-                reactions[current_enzyme] = {'products': [], 'GALD': 0}
-
-            substance = row.get(reaction_col_map.get('compound')) if has_compound else None
-            is_predicted = False
-            rt_deviation = None
-
-            if not has_compound or (pd.notna(substance) and str(substance).strip() == ''):
-                rt_val = row.get(rxn_rt_col)
-                if pd.notna(rt_val):
-                    best_match = None
-                    best_dev = None
-                    for compound, match in rt_matches.items():
-                        dev = float(rt_val) - match['std_rt']
-                        abs_dev = abs(dev)
-                        if abs_dev <= tolerance:
-                            if best_match is None or abs_dev < best_dev:
-                                best_match = compound
-                                best_dev = abs_dev
-                                rt_deviation = round(dev, 6)
-                    if best_match:
-                        substance = best_match
-                        is_predicted = True
-                    else:
-                        substance = 'Unknown'
-
-            if pd.notna(substance) and current_enzyme:
-                peak = row[reaction_col_map['area']]
-                substance = str(substance).strip()
-
-                rt_predictions.append({
-                    'Enzyme': current_enzyme,
-                    'RT': round(float(rt_val), 6) if pd.notna(rt_val) else None,
-                    'Compound': substance if substance != 'Unknown' else None,
-                    'RT_Deviation': f"{rt_deviation:+.6f}" if rt_deviation is not None else '-',
-                    'Peak_Area': round(peak, 6)
-                })
-
-                if substance == 'GALD':
-                    reactions[current_enzyme]['GALD'] = peak
-                elif substance != 'Unknown':
-                    reactions[current_enzyme]['products'].append({
-                        'name': substance,
-                        'peak': peak,
-                        'is_predicted': is_predicted,
-                        'rt_deviation': rt_deviation
-                    })
-
-        if not reactions:
+        parsed, enzymes = parse_reactions(reaction_df, reaction_col_map, rxn_rt_col, rt_matches,
+                                          tolerance=0.15)
+
+        if not enzymes:
             st.error("Reaction data not found")
             st.stop()
 
+        repeated = parsed.loc[parsed['superseded'], 'enzyme'].unique()
+        if len(repeated):
+            st.warning("Enzyme names used for more than one block, only the last block is "
+                       f"counted: {', '.join(repeated)}")
+
+        # Products and GALD both come from each name's last block only
+        counted = parsed[~parsed['superseded']]
+
+        is_gald = counted['compound'] == 'GALD'
+        gald_rows = counted[is_gald].drop_duplicates('enzyme', keep='last')
+        product_rows = counted[~is_gald & (counted['compound'] != 'Unknown')]
+
+        # Blank or non-numeric peak areas are NaN after select_columns. A product
+        # peak without an area is dropped, so it adds no carbon to the yield. A
+        # GALD peak without one stays NaN: the balance is undefined and the yield
+        # is reported as NaN rather than a number
+        no_area = product_rows['peak'].isna()
+        if no_area.any():
+            st.warning(f"{no_area.sum()} product peak(s) without a numeric peak area were left out "
+                       f"of the yield: {', '.join(product_rows.loc[no_area, 'enzyme'].unique())}")
+            product_rows = product_rows[~no_area]
+        no_gald_area = gald_rows.loc[gald_rows['peak'].isna(), 'enzyme']
+        if len(no_gald_area):
+            st.warning("GALD peak without a numeric peak area, no yield calculated for: "
+                       f"{', '.join(no_gald_area)}")
+
         # Show RT matching results by Enzyme
         st.subheader("🔬 RT Matching Results by Enzyme")
-        if rt_predictions:
-            pred_df = pd.DataFrame(rt_predictions)
-            st.dataframe(pred_df)
-
-        if not reactions:
-            st.error("Reaction data not found")
-            st.stop()
+        if len(parsed):
+            st.dataframe(build_rt_match_table(parsed))
 
         # ============ Calculate Carbon Yield ============
-        c4_sugar_names = ['Erythrose', 'Threose', 'Erythrulose', '赤藓糖', '苏阿糖', '赤藓酮糖']
-        c4_mask = standard_df[summary_col_map['compound']].isin(c4_sugar_names)
-        c4_standards = standard_df[c4_mask]
-
-        if len(c4_standards) == 0:
+        c4_response, gald_response = standard_curve(standard_df, summary_col_map['compound'],
+                                                    summary_col_map['area'], summary_col_map['conc'])
+        if c4_response is None:
             st.error("C4 sugar standard data not found")
             st.stop()
-
-        c4_response = (c4_standards[summary_col_map['area']] / c4_standards[summary_col_map['conc']]).mean()
-        
-        gald_mask = standard_df[summary_col_map['compound']] == 'GALD'
-        gald_row = standard_df[gald_mask]
-        
-        if len(gald_row) == 0:
+        if gald_response is None:
             st.error("GALD standard data not found")
             st.stop()
-        
-        gald_response = gald_row[summary_col_map['area']].values[0] / gald_row[summary_col_map['conc']].values[0]
 
         st.success("Standard Curves calculated successfully!")
         st.markdown(f"""
@@ -352,90 +567,81 @@ if uploaded_file:
         </div>
         """, unsafe_allow_html=True)
 
-        results = []
-        for enzyme, data in reactions.items():
-            gald_carbon = (data['GALD'] / gald_response) * (2 * 12 / 60.05)
-            total_product_carbon = 0
-            products = []
-            
-            for prod in data['products']:
-                cf = get_carbon_fraction(prod['name'])
-                conc = prod['peak'] / c4_response
-                carbon = conc * cf
-                total_product_carbon += carbon
-                products.append({'name': prod['name'], 'peak': prod['peak'], 'carbon': carbon})
-            
-            total = gald_carbon + total_product_carbon
-            yield_pct = (total_product_carbon / total) * 100 if total > 0 else 0
-            
-            results.append({
-                'enzyme': enzyme,
-                'yield_pct': round(yield_pct, 2),
-                'conversion_pct': round(100 - yield_pct, 2),
-                'product_carbon': round(total_product_carbon, 4),
-                'gald_carbon': round(gald_carbon, 4),
-                'product_list': ', '.join([p['name'] for p in products]),
-                'products': products,
-                'gald_peak': data['GALD'],
-            })
-        
-        results.sort(key=lambda x: x['yield_pct'], reverse=True)
-        
+        gald_peak = np.zeros(len(enzymes))
+        gald_peak[gald_rows['enzyme_code'].to_numpy()] = gald_rows['peak'].to_numpy(dtype=np.float64)
+        carbon, product_carbon, gald_carbon, yield_pct = compute_yields(
+            product_rows['enzyme_code'].to_numpy(),
+            product_rows['peak'].to_numpy(dtype=np.float64),
+            get_carbon_fractions(product_rows['compound']),
+            gald_peak, c4_response, gald_response)
+
+        # Product details computed once, shared by the expanders and the Excel export
+        product_details = pd.DataFrame({
+            'Enzyme': product_rows['enzyme'],
+            'Compound': product_rows['compound'],
+            'Type': get_sugar_types(product_rows['compound']),
+            'Peak_Area': product_rows['peak'],
+            'Concentration_mg_mL': product_rows['peak'] / c4_response,
+            'Carbon_Mass_mgC_mL': carbon,
+        }).reset_index(drop=True)
+
+        # Rank order from one stable argsort over the yield array (highest first)
+        order = np.argsort(-yield_pct, kind='stable')
+
         # ============ Display Results ============
         st.subheader("📊 Carbon Yield Ranking")
         
-        display_df = pd.DataFrame([{
-            'Rank': i+1,
-            'Enzyme': r['enzyme'],
-            'Carbon_Yield_%': r['yield_pct'],
-            'Conversion_%': r['conversion_pct'],
-            'Product_Carbon': r['product_carbon'],
-            'GALD_Carbon': r['gald_carbon'],
-        } for i, r in enumerate(results)])
+        # Results as columns in rank order, rounded once; shared by the table,
+        # expanders, chart and export
+        results_df = pd.DataFrame({
+            'enzyme': np.array(enzymes, dtype=object)[order],
+            'yield_pct': np.round(yield_pct[order], 2),
+            'conversion_pct': np.round(100 - yield_pct[order], 2),
+            'product_carbon': np.round(product_carbon[order], 4),
+            'gald_carbon': np.round(gald_carbon[order], 4),
+            'gald_peak': gald_peak[order],
+        })
+        display_df = results_df.rename(columns={
+            'enzyme': 'Enzyme',
+            'yield_pct': 'Carbon_Yield_%',
+            'conversion_pct': 'Conversion_%',
+            'product_carbon': 'Product_Carbon',
+            'gald_carbon': 'GALD_Carbon',
+        }).drop(columns='gald_peak')
+        display_df.insert(0, 'Rank', range(1, len(display_df) + 1))
         st.dataframe(display_df)
         
         # ============ Product Details ============
         st.subheader("📦 Product Details by Enzyme")
 
-        for r in results:
-            with st.expander(f"{r['enzyme']} ({r['yield_pct']}% yield)", expanded=False):
-                product_data = []
-                for prod in r['products']:
-                    c_type = get_sugar_type(prod['name'])
-                    conc = prod['peak'] / c4_response
-                    product_data.append({
-                        'Compound': prod['name'] + (" *" if prod.get('is_predicted') else ""),
-                        'Type': c_type,
-                        'Peak_Area': round(prod['peak'], 6),
-                        'Concentration': round(conc, 6),
-                        'Carbon_Mass': round(prod['carbon'], 6),
-                    })
-                st.dataframe(pd.DataFrame(product_data))
+        # Rounded view of the shared details, split once per enzyme
+        details_df = pd.DataFrame({
+            'Compound': product_details['Compound']
+                        + np.where(product_rows['is_predicted'].to_numpy(), " *", ""),
+            'Type': product_details['Type'],
+            'Peak_Area': product_details['Peak_Area'].round(6),
+            'Concentration': product_details['Concentration_mg_mL'].round(6),
+            'Carbon_Mass': product_details['Carbon_Mass_mgC_mL'].round(6),
+        })
+        details_by_enzyme = {
+            enzyme: group.reset_index(drop=True)
+            for enzyme, group in details_df.groupby(product_details['Enzyme'], sort=False)
+        }
+
+        for enzyme, yield_r in zip(results_df['enzyme'], results_df['yield_pct']):
+            with st.expander(f"{enzyme} ({yield_r}% yield)", expanded=False):
+                st.dataframe(details_by_enzyme.get(enzyme, details_df.iloc[:0]))
         
         st.subheader("📈 Visualization")
-        df_chart = pd.DataFrame(results)
-
-        chart = alt.Chart(df_chart).mark_bar(cornerRadiusEnd=4).encode(
-            x=alt.X('enzyme', title='Enzyme', sort='-y'),
-            y=alt.Y('yield_pct', title='Carbon Yield (%)', scale=alt.Scale(domain=[0, 100])),
-            color=alt.Color('yield_pct', scale=alt.Scale(domain=[0, 100], range=['#90CAF9', '#1565C0']), legend=None),
-            tooltip=['enzyme', 'yield_pct', 'conversion_pct', 'product_carbon']
-        ).properties(
-            height=350,
-            width=600
-        ).configure_axis(
-            labelFontSize=12,
-            titleFontSize=14
-        )
-
-        st.altair_chart(chart, use_container_width=True)
+        chart_df = results_df[['enzyme', 'yield_pct', 'conversion_pct', 'product_carbon']]
+        st.vega_lite_chart(build_yield_chart_spec(chart_df), use_container_width=True)
         
         # ============ Download Button ============
         st.divider()
         col1, col2 = st.columns(2)
         
         with col1:
-            excel_data = export_to_excel(results, c4_response, gald_response)
+            excel_data = export_to_excel(results_df, product_details, c4_response, gald_response)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             st.download_button(
                 label="📥 Download Excel Results",